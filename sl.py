@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
+import codecs
 import os
+import pickle
 import pty
 import select
+import selectors
 import subprocess
 import sys
 import re
 import time
-import yaml
 import tty
 import termios
 
@@ -14,34 +16,159 @@ import termios
 # Configuration
 # ----------------------------
 CONFIG_DIR = os.path.join(os.path.dirname(__file__), "configs")
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "status-light")
 MIN_STATE_DURATION = 0.2  # seconds to avoid flicker
+POLL_INTERVAL = 0.1  # seconds between process exit checks when the child has no pidfd
+EXIT_DRAIN_INTERVAL = 0.01  # seconds to wait for more output once the child has exited
+EXIT_DRAIN_TIMEOUT = 0.1  # seconds output is still forwarded after the child exited
+READ_SIZE = 65536  # bytes per read; a burst is drained with as few syscalls as possible
+BUFFER_SIZE = 1024  # characters of earlier output kept for pattern matching
 
 STATE_TO_CMD = {
     "idle": ["a", "0", "0", "0", "255"],        # blue
     "thinking": ["a", "0", "255", "255", "0"],  # yellow
     "waiting": ["a", "0", "100", "0", "0"],     # red
 }
+# Command lines for `led --daemon`, encoded once
+STATE_BYTES = {state: (" ".join(args) + "\n").encode() for state, args in STATE_TO_CMD.items()}
+# (current state, new state) -> command to send; missing pairs are no-op transitions
+TRANSITIONS = {(old, new): STATE_BYTES[new] for old in (None, *STATE_TO_CMD) for new in STATE_TO_CMD if old != new}
 
 LED_SCRIPT = os.path.join(os.path.dirname(__file__), "led")
 
 # ----------------------------
 # Utility functions
 # ----------------------------
+def strip_wildcards(pattern):
+    # A leading or trailing `.*` or `\s*` can match the empty string, so dropping it doesn't
+    # change whether search() finds a match, but lets re jump to the literal that follows
+    while True:
+        m = re.match(r"(?:\.\*|\\s\*)\??", pattern)
+        if not m or pattern[m.end():m.end() + 1] in ("*", "+", "?", "{"):
+            break
+        pattern = pattern[m.end():]
+    while True:
+        m = re.search(r"(?:\.\*|\\s\*)\??$", pattern)
+        if not m:
+            break
+        # The token must not be escaped itself (e.g. `\.*` or `\\s*`)
+        escapes = len(pattern[:m.start()]) - len(pattern[:m.start()].rstrip("\\"))
+        if escapes % 2:
+            break
+        pattern = pattern[:m.start()]
+    return pattern
+
+# Group references that would point at the wrong group once patterns are fused:
+# unescaped \1-\9, (?P=name) and conditionals (?(1)...)
+GROUP_REFERENCE = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?P=|\(\?\(")
+
+class PatternList:
+    # Stands in for a fused group when its patterns can't be joined safely;
+    # search() returns the leftmost match of any pattern like the fused regex would
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def search(self, string, pos=0):
+        matches = [m for m in (p.search(string, pos) for p in self.patterns) if m]
+        return min(matches, key=lambda m: m.start(), default=None)
+
+def compile_group(group_patterns):
+    compiled = [re.compile(strip_wildcards(p), re.MULTILINE) for p in group_patterns]
+    # Inline global flags like (?i) only work at the start of a whole expression,
+    # and group numbers shift when patterns are fused, so those groups stay separate
+    default_flags = re.compile("", re.MULTILINE).flags
+    if any(p.flags != default_flags or GROUP_REFERENCE.search(p.pattern) for p in compiled):
+        return PatternList(compiled)
+    try:
+        return re.compile("|".join(f"(?:{p.pattern})" for p in compiled), re.MULTILINE)
+    except re.error:  # e.g. the same group name used in two patterns
+        return PatternList(compiled)
+
+def compile_patterns(config):
+    # Fuse each pattern group into a single alternation so every read is one scan
+    # per group; a group without patterns compiles to None
+    patterns = config.setdefault("patterns", {})
+    # Longest pattern source bounds how far back a match can start before new output
+    config["scan_overlap"] = max((len(p) for p in patterns.get("thinking") or []), default=0)
+    for group in ("waiting", "thinking"):
+        group_patterns = patterns.get(group) or []
+        patterns[group] = compile_group(group_patterns) if group_patterns else None
+    return config
+
+def read_config(path):
+    # Parsed configs are pickled in CACHE_DIR, keyed by path and mtime, so warm starts
+    # skip importing PyYAML and parsing; any cache problem falls back to the YAML file
+    key = (path, os.stat(path).st_mtime_ns)
+    cache_path = os.path.join(CACHE_DIR, os.path.basename(path) + ".pkl")
+    try:
+        with open(cache_path, "rb") as f:
+            cached_key, config = pickle.load(f)
+        if cached_key == key:
+            return config
+    except Exception:
+        pass
+
+    import yaml
+    try:
+        from yaml import CSafeLoader as SafeLoader  # libyaml's C parser, when PyYAML was built with it
+    except ImportError:
+        from yaml import SafeLoader
+    with open(path) as f:
+        config = yaml.load(f, Loader=SafeLoader)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((key, config), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        pass
+    return config
+
 def load_config(tool_name):
     try:
-        with open(os.path.join(CONFIG_DIR, f"{tool_name}.yaml")) as f:
-            return yaml.safe_load(f)
+        return compile_patterns(read_config(os.path.join(CONFIG_DIR, f"{tool_name}.yaml")))
     except FileNotFoundError:
         try:
-            with open(os.path.join(CONFIG_DIR, "default.yaml")) as f:
-                return yaml.safe_load(f)
+            return compile_patterns(read_config(os.path.join(CONFIG_DIR, "default.yaml")))
         except FileNotFoundError:
-            return {"patterns": {}, "idle_threshold_ms": 500}
+            return compile_patterns({"patterns": {}, "idle_threshold_ms": 500})
+
+def read_available(fd):
+    # Drain a non-blocking fd; returns everything readable right now and whether EOF was hit
+    chunks = []
+    while True:
+        try:
+            chunk = os.read(fd, READ_SIZE)
+        except BlockingIOError:
+            return b"".join(chunks), False
+        except OSError:
+            return b"".join(chunks), True
+        if not chunk:
+            return b"".join(chunks), True
+        chunks.append(chunk)
+
+def write_all(fd, data):
+    # Write everything to a possibly non-blocking fd, waiting while it is full
+    view = memoryview(data)
+    while view:
+        try:
+            view = view[os.write(fd, view):]
+        except BlockingIOError:
+            select.select([], [fd], [])
 
-def set_led(state):
-    args = STATE_TO_CMD.get(state, STATE_TO_CMD["idle"])
-    cmd = [LED_SCRIPT] + args
-    subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+def start_led():
+    # One long-lived `led --daemon` reads a command per line, instead of a fork+exec per change.
+    # It runs in its own session so a Ctrl-C meant for the tool can't kill it before the final "o".
+    return subprocess.Popen([LED_SCRIPT, "--daemon"], stdin=subprocess.PIPE, bufsize=0,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+def send_led(led, line):
+    try:
+        led.stdin.write(line)
+    except OSError:
+        pass  # LED updates are best effort, as before; a dead daemon must not stop the tool
 
 # ----------------------------
 # Core PTY wrapper
@@ -49,112 +176,190 @@ def set_led(state):
 def run_tool(tool_cmd, config):
     last_state = None
     last_change = 0
+    led = start_led()
 
     def update_state(state):
         nonlocal last_state, last_change
-        now = time.time()
-        if state != last_state and now - last_change > MIN_STATE_DURATION:
-            set_led(state)
+        command = TRANSITIONS.get((last_state, state))
+        if command is None:
+            return
+        now = time.monotonic()
+        if now - last_change > MIN_STATE_DURATION:
+            send_led(led, command)
             last_state = state
             last_change = now
 
     master_fd, slave_fd = pty.openpty()
     proc = subprocess.Popen(tool_cmd, stdin=slave_fd, stdout=slave_fd, stderr=slave_fd, close_fds=True)
     os.close(slave_fd)
+    os.set_blocking(master_fd, False)
 
     # Save original terminal settings and set to raw mode (only if stdin is a TTY)
     old_settings = None
+    stdin_fd = sys.stdin.fileno()
     if sys.stdin.isatty():
         old_settings = termios.tcgetattr(sys.stdin)
-        tty.setraw(sys.stdin.fileno())
+        tty.setraw(stdin_fd)
+
+    # Register the fds once; the default selector is epoll on Linux
+    selector = selectors.DefaultSelector()
+    selector.register(master_fd, selectors.EVENT_READ)
+    # Only monitor stdin if it's a TTY
+    if old_settings is not None:
+        selector.register(stdin_fd, selectors.EVENT_READ)
+    # A pidfd becomes readable when the child exits, so the loop can block instead of
+    # polling for the exit (Linux 5.3+; elsewhere fall back to proc.poll() on timeouts)
+    try:
+        pidfd = os.pidfd_open(proc.pid)
+        selector.register(pidfd, selectors.EVENT_READ)
+    except (AttributeError, OSError):
+        pidfd = None
+    exited = False
+    exit_deadline = None
 
     try:
-        buffer = b""
-        idle_timer = time.time()
+        # Decode output incrementally so each read only decodes the new bytes;
+        # multi-byte characters split across reads are completed on the next one
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        buffer = ""
+        buffer_end = 0         # total characters seen, i.e. absolute offset of the end of buffer
+        thinking_scanned = 0   # absolute offset up to which thinking patterns have been scanned
+        thinking_seen = -1     # absolute offset of the latest thinking match
+        idle_threshold = config.get("idle_threshold_ms", 500) / 1000
+        # Going idle is driven by the selector timeout: while a deadline is pending
+        # the selector waits exactly until it, so an empty result means it passed
+        idle_deadline = time.monotonic() + idle_threshold
+        waiting_re = config["patterns"]["waiting"]
+        thinking_re = config["patterns"]["thinking"]
+        scan_overlap = config["scan_overlap"]
+        # Forward output straight to the fd, bypassing Python's buffered IO and per-chunk flushes
+        stdout_fd = sys.stdout.fileno()
+        # Bind everything the loop touches on each read to locals
+        debug = bool(os.getenv("DEBUG_SL"))
+        monotonic = time.monotonic
+        select_ready = selector.select
+        decode = decoder.decode
+        poll = proc.poll
 
         while True:
-            # Only monitor stdin if it's a TTY
-            if old_settings is not None:
-                rlist, _, _ = select.select([master_fd, sys.stdin], [], [], 0.1)
+            if exited:
+                timeout = EXIT_DRAIN_INTERVAL
+            elif idle_deadline is not None:
+                timeout = max(0, idle_deadline - monotonic())
+            elif pidfd is None:
+                timeout = POLL_INTERVAL
             else:
-                rlist, _, _ = select.select([master_fd], [], [], 0.1)
+                timeout = None
+            rlist = [key.fd for key, _ in select_ready(timeout)]
+
+            # The child exited; keep forwarding what it wrote for at most EXIT_DRAIN_TIMEOUT
+            if pidfd is not None and pidfd in rlist:
+                selector.unregister(pidfd)
+                os.close(pidfd)
+                pidfd = None
+                exited = True
+                exit_deadline = monotonic() + EXIT_DRAIN_TIMEOUT
 
             # Handle input from stdin -> forward to subprocess (only if stdin is TTY)
-            if old_settings is not None and sys.stdin in rlist:
+            if old_settings is not None and stdin_fd in rlist:
                 try:
-                    data = os.read(sys.stdin.fileno(), 1024)
+                    data = os.read(stdin_fd, READ_SIZE)
                 except OSError:
                     break
                 if not data:
                     break
-                os.write(master_fd, data)
+                write_all(master_fd, data)
 
             # Handle output from subprocess -> forward to stdout
             if master_fd in rlist:
-                try:
-                    data = os.read(master_fd, 1024)
-                except OSError:
-                    break
-                if not data:
+                # Drain the whole burst so it is forwarded and scanned once
+                data, eof = read_available(master_fd)
+                if eof and not data:
                     break
-                sys.stdout.buffer.write(data)
-                sys.stdout.buffer.flush()
-                buffer += data
-                idle_timer = time.time()
-
-                text = buffer.decode(errors="ignore")
-
-                # Get last N lines for checking UI state (prompt area)
-                lines = text.split('\n')
-                tail_lines = '\n'.join(lines[-10:])  # Last 10 lines for prompt/UI checks
-                full_buffer = text  # Entire buffer for thinking indicators
-
-                # Debug: Log buffer content to stderr if DEBUG env var is set
-                if os.getenv("DEBUG_SL"):
-                    sys.stderr.write(f"\n[DEBUG] Tail: {repr(tail_lines[-200:])}\n")
-                    sys.stderr.flush()
-
-                # Check waiting patterns on tail (last lines) - these are UI state indicators
-                waiting_match = None
-                for p in config.get("patterns", {}).get("waiting", []):
-                    if re.search(p, tail_lines, re.MULTILINE):
-                        waiting_match = p
-                        break
-
-                if waiting_match:
-                    if os.getenv("DEBUG_SL"):
-                        sys.stderr.write(f"[DEBUG] State: WAITING (matched: {waiting_match})\n")
-                    update_state("waiting")
-                else:
-                    # Check thinking patterns on entire buffer - thinking indicators can appear anywhere
-                    thinking_match = None
-                    for p in config.get("patterns", {}).get("thinking", []):
-                        if re.search(p, full_buffer, re.MULTILINE):
-                            thinking_match = p
+                write_all(stdout_fd, data)
+                text = decode(data)
+                # Patterns are matched against the last BUFFER_SIZE characters before this read plus the new text
+                window_start = buffer_end - len(buffer)  # absolute offset of buffer[0]
+                buffer += text
+                buffer_end += len(text)
+                now = monotonic()
+                idle_deadline = now + idle_threshold
+
+                # Right after a state change update_state would drop any result, so skip
+                # scanning; the unscanned text is picked up by the next scan
+                if now - last_change > MIN_STATE_DURATION:
+                    # Find the start of the last 10 lines for checking UI state (prompt area)
+                    tail = len(buffer)
+                    for _ in range(10):
+                        tail = buffer.rfind('\n', 0, tail)
+                        if tail < 0:
                             break
+                    tail = tail + 1 if tail >= 0 else 0
+
+                    # Debug: Log buffer content to stderr if DEBUG env var is set
+                    if debug:
+                        sys.stderr.write(f"\n[DEBUG] Tail: {repr(buffer[max(tail, len(buffer) - 200):])}\n")
+                        sys.stderr.flush()
+
+                    # Check waiting patterns on tail (last lines) - these are UI state indicators
+                    waiting_match = waiting_re and waiting_re.search(buffer, tail)
 
-                    if thinking_match:
-                        if os.getenv("DEBUG_SL"):
-                            sys.stderr.write(f"[DEBUG] State: THINKING (matched: {thinking_match})\n")
-                        update_state("thinking")
-                buffer = buffer[-1024:]  # keep last 1k bytes
+                    if waiting_match:
+                        if debug:
+                            sys.stderr.write(f"[DEBUG] State: WAITING (matched: {waiting_match.group()!r})\n")
+                        update_state("waiting")
+                    else:
+                        # Check thinking patterns on entire buffer - thinking indicators can appear anywhere.
+                        # Only text not scanned yet is searched, starting at the unfinished line before it
+                        # so matches spanning two reads are found; earlier matches are remembered by offset.
+                        scan_from = max(0, thinking_scanned - window_start)
+                        scan_from = max(0, min(buffer.rfind('\n', 0, scan_from) + 1, scan_from - scan_overlap))
+                        thinking_match = thinking_re and thinking_re.search(buffer, scan_from)
+                        thinking_scanned = buffer_end
+                        if thinking_match:
+                            thinking_seen = window_start + thinking_match.start()
+                        elif 0 <= thinking_seen < window_start:
+                            # The remembered match scrolled out; look once for a later one still in the window
+                            earlier = thinking_re.search(buffer)
+                            thinking_seen = window_start + earlier.start() if earlier else -1
+
+                        if thinking_seen >= window_start:
+                            if debug:
+                                matched = repr(thinking_match.group()) if thinking_match else "earlier match"
+                                sys.stderr.write(f"[DEBUG] State: THINKING (matched: {matched})\n")
+                            update_state("thinking")
+                buffer = buffer[-BUFFER_SIZE:]  # keep last 1k characters
+                if eof:
+                    break
 
             # no new data, check for idle (but don't go idle if we're in waiting state)
-            if not rlist:
-                if (time.time() - idle_timer)*1000 > config.get("idle_threshold_ms", 500):
-                    # Only switch to idle if we're not in a waiting state
-                    if last_state != "waiting":
-                        update_state("idle")
-
-            # check if process exited
-            if proc.poll() is not None:
+            if not rlist and idle_deadline is not None:
+                # Only switch to idle if we're not in a waiting state
+                if last_state != "waiting":
+                    update_state("idle")
+                # Retry shortly if the debounce held the switch back
+                idle_deadline = None if last_state in ("idle", "waiting") else monotonic() + POLL_INTERVAL
+
+            # Without a pidfd, check if the process exited on every iteration
+            if pidfd is None and not exited and poll() is not None:
+                exited = True
+                exit_deadline = monotonic() + EXIT_DRAIN_TIMEOUT
+
+            # Stop once the remaining output has been drained, or after EXIT_DRAIN_TIMEOUT
+            # if a grandchild keeps writing to the PTY
+            if exited and (not rlist or monotonic() >= exit_deadline):
                 update_state("idle")
                 break
 
         proc.wait()
     finally:
-        # Turn off LED
-        subprocess.run([LED_SCRIPT, "o"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        selector.close()
+        if pidfd is not None:
+            os.close(pidfd)
+        # Turn off LED and let the daemon exit
+        send_led(led, b"o\n")
+        led.stdin.close()
+        led.wait()
         # Restore original terminal settings (if they were saved)
         if old_settings is not None:
             termios.tcsetattr(sys.stdin, termios.TCSADRAIN, old_settings)
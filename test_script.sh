@@ -77,6 +77,21 @@ echo "[INFO] Cleaning up temporary files..."
 sleep 0.6
 echo ""
 
+# Long burst: two thinking indicators arrive in one read. Each plain line after
+# an idle pause must bring back THINKING while the second "Compiling" is still in
+# the 1KB buffer, also once the first one has scrolled out of it
+echo "========================================="
+echo "Stage 6: Long burst"
+echo "========================================="
+# (kept on one line: the PTY hands each line to the reader separately)
+printf 'Compiling %s Compiling %s\n' "$(printf '%600s' '' | tr ' ' 'a')" "$(printf '%100s' '' | tr ' ' 'a')"
+sleep 1
+printf '%400s\n' '' | tr ' ' '-'
+sleep 1
+printf '%400s\n' '' | tr ' ' '-'
+sleep 0.8
+echo ""
+
 # Completion
 echo "========================================="
 echo "Test Complete!"